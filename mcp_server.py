@@ -7,217 +7,831 @@ Intelligent, dynamic interaction with any SAP OData service without restrictions
 
 import json
 import sys
+import http.client
+import http.cookiejar
 import urllib.request
 import urllib.parse
-import urllib.error
 import base64
 import os
 import re
-from typing import Dict, Any, Optional, List
+import threading
+import time
+import atexit
+import uuid
+import email.parser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, List, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    # orjson is an optional speedup; the stdlib json module is used otherwise
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    # pysimdjson is optional too; without it lazy parses fall back to _json_loads
+    simdjson = None
+
+# KEY=value lines of a .env file; comments and blank lines never match
+_ENV_LINE_RE = re.compile(r'^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t]*$', re.M)
+
+# HTTP methods that need a CSRF token, and those that carry a request body
+_WRITE_METHODS = frozenset({"POST", "PUT", "PATCH", "DELETE"})
+_BODY_METHODS = frozenset({"POST", "PUT", "PATCH"})
+# Methods that are safe to resend after a transport failure
+_IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+# Transport errors worth retrying with backoff; DNS, TLS verification, timeouts and partial reads
+# would fail the same way again, so they surface immediately
+_TRANSIENT_ERRORS = (ConnectionResetError, ConnectionAbortedError, ConnectionRefusedError, http.client.RemoteDisconnected)
+# Statuses whose Location is followed, as urllib did before requests went through the connection pool
+_REDIRECT_STATUSES = frozenset({301, 302, 303, 307, 308})
+
+# Well-known services probed when the gateway catalog is unavailable
+_COMMON_SERVICES = (
+    "API_CUSTOMER_SRV", "API_BILLING_DOCUMENT_SRV", "API_SALES_ORDER_SRV",
+    "API_MATERIAL_SRV", "API_SUPPLIER_SRV", "API_FINANCIALSTATEMENT_SRV",
+    "API_PURCHASE_ORDER_SRV", "API_BUSINESS_PARTNER_SRV"
+)
+_COMMON_SERVICE_DESCRIPTIONS = {
+    name: f"SAP {name.replace('API_', '').replace('_SRV', '')} Service" for name in _COMMON_SERVICES
+}
+
+# Error-message fragments and the diagnosis sap_test_connection shows for them, checked in order
+_CONNECTION_DIAGNOSES = (
+    ("nodename nor servname provided", "❌ DNS Resolution Error - Check SAP server hostname"),
+    ("timed out", "❌ Connection Timeout - Check SAP server accessibility"),
+    ("401", "❌ Authentication Error - Check credentials"),
+    ("404", "❌ Service Not Found - Check OData service URL"),
+)
+
+# Report text for sap_test_connection and sap_service_info. The *_TEMPLATE strings hold
+# {placeholders} that the tools fill with .format_map(); the header, the tool list and the
+# not-configured message are fixed text, spliced into the templates or returned as-is
+_NOT_CONFIGURED_MESSAGE = "❌ SAP not configured. Create .env file with:\nSAP_URL=your_sap_url\nSAP_USERNAME=your_username (optional)\nSAP_PASSWORD=your_password (optional)"
+
+_CONFIG_HEADER = "🔧 Configuration:"
+
+_CONFIG_TEMPLATE = _CONFIG_HEADER + """
+- URL: {base_url}
+- Username: {username}
+- Password: {has_password}"""
+
+_AVAILABLE_TOOLS_BLOCK = """🛠️ Available Tools:
+- sap_query (flexible querying)
+- sap_create (create entities)
+- sap_update (update entities)
+- sap_delete (delete entities)
+- sap_function (call functions)
+- sap_batch (batch operations)
+- sap_discover (explore structure)
+- sap_raw_request (maximum flexibility)"""
+
+_CONNECTION_OK_TEMPLATE = """✅ SAP Connection Status: SUCCESS
+
+""" + _CONFIG_TEMPLATE + """
+- CSRF Support: {csrf_available}
+
+📊 Service Capabilities:
+- Entity Sets: {entity_count}
+- Read Operations: ✅ Available
+- Write Operations: {write_status}
+- Function Imports: ✅ Available
+- Batch Operations: ✅ Available
+
+""" + _AVAILABLE_TOOLS_BLOCK + """
+
+Ready for intelligent SAP interaction! 🚀"""
+
+_CONNECTION_FAILED_TEMPLATE = """❌ SAP Connection Status: FAILED
+
+""" + _CONFIG_TEMPLATE + """
+
+🔍 Diagnosis: {diagnosis}
+
+Please check your .env file configuration and network connectivity."""
+
+_SERVICE_INFO_TEMPLATE = """📊 SAP Service Information:
+
+""" + _CONFIG_HEADER + """
+- Base URL: {base_url}
+- Current Service: {current_service}
+- Available Services: {service_count}
+
+📋 Available Services:
+{services_list}{more_services}
+
+🛠️ Available Operations:
+- sap_switch_service: Change active service
+- sap_smart_query: Auto-find service for entity
+- sap_discover_services: Find all services
+- sap_query: Query current service"""
+
+# OData V2 bookkeeping properties (__metadata, __deferred, ...) start with this
+_INTERNAL_PREFIX = "__"
+
+# sap_query arguments mapped to their OData system query options
+_QUERY_OPTIONS = (
+    ("filter", "$filter", str),
+    ("select", "$select", str),
+    ("expand", "$expand", str),
+    ("orderby", "$orderby", str),
+    ("top", "$top", str),
+    ("skip", "$skip", str),
+    ("format", "$format", str),
+)
+
+# JSON-RPC envelopes; the id and payload are spliced in already serialized
+_RESULT_ENVELOPE = b'{"jsonrpc":"2.0","id":%s,"result":%s}'
+_TEXT_RESULT_ENVELOPE = b'{"jsonrpc":"2.0","id":%s,"result":{"content":[{"type":"text","text":%s}]}}'
+_ERROR_ENVELOPE = b'{"jsonrpc":"2.0","id":%s,"error":{"code":-1,"message":%s}}'
+
+# JSON-RPC messages handled at once by main(); tool calls spend most of their time waiting on SAP
+_MAX_CONCURRENT_REQUESTS = 8
+
+
+def _result_rows(payload: Any) -> Any:
+    """Row collection of an OData payload: d.results / d.EntitySets (V2), value (V4) or EntitySets"""
+    if not hasattr(payload, "get"):
+        return ()
+    d = payload.get("d")
+    if d is not None and hasattr(d, "get"):
+        rows = d.get("results")
+        if rows is None:
+            rows = d.get("EntitySets")
+        if rows is not None:
+            return rows
+    return payload.get("value", payload.get("EntitySets", ()))
+
+
+def _describe_value(value: Any) -> Dict[str, Any]:
+    """Type name and sample of a field value, with long values truncated to 100 characters"""
+    value_type = type(value)
+    if value is None or value_type in (bool, int, float):
+        # JSON scalars are always short enough to show as-is
+        return {"type": value_type.__name__, "sample_value": value}
+    text = str(value)
+    return {"type": value_type.__name__, "sample_value": text[:100] if len(text) > 100 else value}
+
+
+def _json_loads(raw: Union[str, bytes]) -> Any:
+    """Parse JSON from str or bytes, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _json_bytes(obj: Any) -> bytes:
+    """Serialize to compact UTF-8 JSON bytes (request bodies, JSON-RPC responses)"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def _json_dumps(obj: Any, pretty: bool = False) -> str:
+    """Serialize to a JSON string, indented by two spaces when pretty is set"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0).decode('utf-8')
+    return json.dumps(obj, indent=2 if pretty else None)
+
+
+def _has_content(data: bytes) -> bool:
+    """Whether a response body holds anything but whitespace"""
+    # isspace() stops at the first non-blank byte, unlike strip() which copies the payload
+    return bool(data) and not data.isspace()
+
+
+def _parse_response_body(data: bytes, method: str) -> Dict[str, Any]:
+    """Parse a JSON response body, or describe an empty one as a completed operation"""
+    if _has_content(data):
+        return _json_loads(data)
+    return {"status": "success", "message": f"{method} operation completed"}
+
+
+def _operation_method(operation: Dict[str, Any]) -> Optional[str]:
+    """Upper-cased HTTP method of a batch operation (GET when unset), None when it isn't a string"""
+    method = operation.get("method") or "GET"
+    return method.upper() if isinstance(method, str) else None
+
+
+def _read_key(operation: Dict[str, Any]) -> Optional[tuple]:
+    """Canonical (path, sorted query) key for a GET operation, None for anything else"""
+    if _operation_method(operation) != "GET":
+        return None
+    path, _, query = operation.get("url", "").lstrip('/').partition('?')
+    return path, tuple(sorted(urllib.parse.parse_qsl(query, keep_blank_values=True)))
+
+
+def _build_batch_body(operations: List[Dict[str, Any]], boundary: str) -> bytes:
+    """Compose a multipart/mixed $batch body; each write is wrapped in its own changeset"""
+    parts = []
+    for operation in operations:
+        method = _operation_method(operation)
+        url = operation.get("url", "").lstrip('/')
+        if method == "GET":
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n\r\n"
+                f"GET {url} HTTP/1.1\r\nAccept: application/json\r\n\r\n\r\n".encode('utf-8'))
+            continue
+        
+        data = operation.get("data")
+        payload = _json_bytes(data) if data and method in _BODY_METHODS else b""
+        changeset = f"changeset_{uuid.uuid4().hex}"
+        parts.append(
+            f"--{boundary}\r\nContent-Type: multipart/mixed; boundary={changeset}\r\n\r\n"
+            f"--{changeset}\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n\r\n"
+            f"{method} {url} HTTP/1.1\r\nAccept: application/json\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n\r\n".encode('utf-8')
+            + payload + f"\r\n--{changeset}--\r\n".encode('utf-8'))
+    parts.append(f"--{boundary}--\r\n".encode('utf-8'))
+    return b"".join(parts)
+
+
+def _parse_batch_response(content_type: str, body: bytes) -> List[Tuple[Optional[int], bytes]]:
+    """Split a multipart $batch reply into (status, body) pairs, changesets flattened in order
+    
+    A part without a readable HTTP status line gets a None status, so only
+    that operation fails instead of the whole (possibly committed) batch.
+    """
+    message = email.parser.BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + body)
+    if not message.is_multipart():
+        raise ValueError(f"Unexpected $batch response type: {content_type}")
+    
+    responses = []
+    for part in message.get_payload():
+        # A failed changeset comes back as a single error response instead of a nested multipart
+        for http_part in (part.get_payload() if part.is_multipart() else [part]):
+            raw = http_part.get_payload(decode=True) or b""
+            head, separator, payload = raw.partition(b"\r\n\r\n")
+            if not separator:
+                head, _, payload = raw.partition(b"\n\n")
+            status_line = head.lstrip().split(b"\n", 1)[0].split()
+            try:
+                responses.append((int(status_line[1]), payload))
+            except (IndexError, ValueError):
+                responses.append((None, raw))
+    return responses
+
+
+class SAPHTTPError(Exception):
+    """SAP answered with an HTTP error status"""
+    
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _CookieResponse:
+    """Adapter giving http.cookiejar the info() accessor it expects on a response"""
+    
+    def __init__(self, headers: http.client.HTTPMessage):
+        self._headers = headers
+    
+    def info(self) -> http.client.HTTPMessage:
+        return self._headers
+
+
+class _HTTPConnectionPool:
+    """Keep-alive HTTP(S) connections shared across requests, per host
+    
+    Idempotent requests that fail before a response arrives are retried up to
+    `retries` times with exponential backoff; timeouts are not retried.
+    """
+    
+    def __init__(self, maxsize: int = 8, retries: int = 3, backoff_factor: float = 0.2):
+        self.maxsize = maxsize
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._idle: Dict[tuple, List[http.client.HTTPConnection]] = {}
+        # (scheme, host, port) -> (proxy host, proxy port, proxy auth headers), None when connecting directly
+        self._proxies: Dict[tuple, Optional[Tuple[str, int, Dict[str, str]]]] = {}
+        self._lock = threading.Lock()
+    
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+    
+    def _proxy(self, key: tuple) -> Optional[Tuple[str, int, Dict[str, str]]]:
+        """The environment's proxy for a (scheme, host, port) key, or None to connect directly"""
+        if key in self._proxies:
+            return self._proxies[key]
+        
+        scheme, host, _ = key
+        proxy = urllib.request.getproxies().get(scheme)
+        if not proxy or urllib.request.proxy_bypass(host):
+            self._proxies[key] = None
+            return None
+        
+        proxy_url = urllib.parse.urlsplit(proxy if '://' in proxy else f"http://{proxy}")
+        proxy_headers = {}
+        if proxy_url.username:
+            credentials = f"{urllib.parse.unquote(proxy_url.username)}:{urllib.parse.unquote(proxy_url.password or '')}"
+            proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+        self._proxies[key] = (proxy_url.hostname, proxy_url.port or 8080, proxy_headers)
+        return self._proxies[key]
+    
+    def _connect(self, key: tuple, timeout: float) -> http.client.HTTPConnection:
+        """Open a new connection, going through the environment's proxy if one applies"""
+        scheme, host, port = key
+        proxy = self._proxy(key)
+        if proxy is None:
+            conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            return conn_class(host, port, timeout=timeout)
+        
+        proxy_host, proxy_port, proxy_headers = proxy
+        if scheme != 'https':
+            # Plain HTTP is sent to the proxy as absolute-form requests; many proxies only allow CONNECT to 443
+            return http.client.HTTPConnection(proxy_host, proxy_port, timeout=timeout)
+        conn = http.client.HTTPSConnection(proxy_host, proxy_port, timeout=timeout)
+        conn.set_tunnel(host, port, headers=proxy_headers)
+        return conn
+    
+    def request(self, method: str, url: str, body: Optional[bytes] = None, headers: Dict[str, str] = None,
+                timeout: float = 60) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        """Send a request and return (status, headers, body), reusing an idle connection when possible"""
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        target = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        proxy = self._proxy(key) if parts.scheme != 'https' else None
+        if proxy is not None:
+            target = urllib.parse.urlunsplit((parts.scheme, parts.netloc.rpartition('@')[2], parts.path or '/', parts.query, ''))
+            headers = dict(headers or {}, **proxy[2])
+        
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        reused = conn is not None
+        attempt = 0
+        
+        while True:
+            if conn is None:
+                conn = self._connect(key, timeout)
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            sent = False
+            try:
+                conn.request(method, target, body=body, headers=headers or {})
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                conn = None
+                # The server dropped an idle keep-alive connection; retry once on a fresh one. A write
+                # is only resent when it failed while still being sent; once the whole request is out,
+                # SAP may have committed it even if no response came back
+                if reused and (isinstance(e, (ConnectionError, http.client.BadStatusLine)) if method in _IDEMPOTENT_METHODS
+                               else not sent and isinstance(e, (BrokenPipeError, ConnectionResetError))):
+                    reused = False
+                    continue
+                if method not in _IDEMPOTENT_METHODS or not isinstance(e, _TRANSIENT_ERRORS) or attempt >= self.retries:
+                    raise
+                time.sleep(self.backoff_factor * (2 ** attempt))
+                attempt += 1
+            except Exception:
+                conn.close()
+                raise
+        
+        if response.will_close:
+            conn.close()
+        else:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.maxsize:
+                    idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+        return response.status, response.headers, data
 
 
 class SAPODataClient:
     """Intelligent SAP OData client with dynamic multi-service capabilities"""
     
+    __slots__ = (
+        "base_url", "username", "password", "_auth_header", "_http",
+        "_csrf_token", "_csrf_expires", "_cookies", "_service",
+        "_metadata_cache", "_metadata_format", "_etag_cache", "_service_doc_cache",
+        "_available_services", "_entity_to_service", "_index_lock", "_service_catalog", "_sj",
+    )
+    
+    SERVICE_PREFIX = '/sap/opu/odata/sap/'
+    
+    # $metadata?$format=json answers that mean the service only has XML metadata
+    XML_ONLY_METADATA_STATUSES = frozenset({400, 406, 415, 500, 501})
+    
+    # $batch answers that mean the service doesn't support it; anything else is a real failure
+    BATCH_UNSUPPORTED_STATUSES = frozenset({400, 404, 405, 501})
+    
+    # Seconds a fetched CSRF token is reused before fetching a new one
+    CSRF_TOKEN_TTL = 300
+    
+    # Redirect hops followed per request (http -> https, trailing slash, login hops, ...)
+    MAX_REDIRECTS = 5
+    
     def __init__(self, base_url: str, username: str = None, password: str = None):
         # Handle both base URLs and service-specific URLs
-        if '/sap/opu/odata/sap/' in base_url and base_url.count('/') > 5:
+        host_part, prefix, service_part = base_url.partition(self.SERVICE_PREFIX)
+        if prefix:
             # Extract base URL from service-specific URL
-            parts = base_url.split('/sap/opu/odata/sap/')
-            self.base_url = parts[0] + '/sap/opu/odata/sap'
-            self.current_service = parts[1] if len(parts) > 1 else None
+            self.base_url = host_part + self.SERVICE_PREFIX.rstrip('/')
+            self.current_service = service_part.rstrip('/') or None
         else:
             self.base_url = base_url.rstrip('/')
             self.current_service = None
             
         self.username = username
         self.password = password
-        self._metadata_cache = {}
+        self._auth_header = None
+        if username and password:
+            credentials = f"{username}:{password}".encode('utf-8')
+            self._auth_header = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+        # Sized for the 16 concurrent service-document fetches of _build_entity_index
+        self._http = _HTTPConnectionPool(maxsize=16)
+        atexit.register(self._http.close)
+        self._csrf_token = None
+        self._csrf_expires = 0.0
+        self._cookies = http.cookiejar.CookieJar()
+        # Service name (or 'default') -> parsed metadata, like _metadata_format
+        self._metadata_cache: Dict[str, Any] = {}
+        self._metadata_format: Dict[str, str] = {}
+        # URL -> (ETag, body) for conditional GETs
+        self._etag_cache: Dict[str, Tuple[str, bytes]] = {}
         self._service_doc_cache = {}
         self._available_services = []
+        self._entity_to_service: Optional[Dict[str, str]] = None
+        # Concurrent lookups share one index build instead of each fanning out over every service
+        self._index_lock = threading.Lock()
         self._service_catalog = None
+        # simdjson parsers are not thread-safe, so each thread gets its own
+        self._sj = threading.local()
     
-    def _make_request(self, endpoint: str, params: Dict[str, str] = None, method: str = "GET", data: str = None, service: str = None) -> Dict[str, Any]:
-        """Make HTTP request to SAP OData service with full HTTP method support"""
-        # Use specified service or current service
-        target_service = service or self.current_service
+    @property
+    def current_service(self) -> Optional[str]:
+        """Name of the active OData service, if any"""
+        return self._service[0]
+    
+    @current_service.setter
+    def current_service(self, service_name: Optional[str]):
+        # (name, root that its request URLs are built on), swapped in one assignment so
+        # requests running concurrently with a service switch never pair one with the other
+        self._service = (service_name, f"{self.base_url}/{service_name}" if service_name else self.base_url)
+    
+    def _parse_lazy(self, raw_bytes: bytes) -> Any:
+        """Parse JSON lazily; nested values are only materialized when accessed"""
+        parser = getattr(self._sj, 'parser', None)
+        if parser is None:
+            parser = self._sj.parser = simdjson.Parser()
+        return parser.parse(raw_bytes)
+    
+    def _send(self, method: str, endpoint: str, params: Dict[str, str] = None, body: bytes = None,
+              service: str = None, content_type: str = 'application/json',
+              conditional: bool = False) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        """Send a request to an SAP service and return (status, headers, body); error statuses raise SAPHTTPError
         
-        if target_service:
-            url = f"{self.base_url}/{target_service}/{endpoint.lstrip('/')}" if endpoint else f"{self.base_url}/{target_service}"
+        With conditional=True a GET revalidates the last ETag-tagged body for the
+        same URL, and a 304 answer returns that body without transferring it again.
+        """
+        # Use specified service or current service
+        current_service, current_root = self._service
+        if not service or service == current_service:
+            root = current_root
         else:
-            url = f"{self.base_url}/{endpoint.lstrip('/')}" if endpoint else self.base_url
+            root = f"{self.base_url}/{service}"
+        url = f"{root}/{endpoint.lstrip('/')}" if endpoint else root
         
         if params:
             query_string = urllib.parse.urlencode(params)
             url += f"?{query_string}"
         
-        request = urllib.request.Request(url, method=method.upper())
-        request.add_header('Accept', 'application/json')
-        request.add_header('Content-Type', 'application/json')
-        
-        # Add CSRF token for write operations
-        if method.upper() in ['POST', 'PUT', 'PATCH', 'DELETE']:
-            csrf_token = self._get_csrf_token()
-            if csrf_token:
-                request.add_header('X-CSRF-Token', csrf_token)
+        method = method.upper()
+        headers = {'Accept': 'application/json', 'Content-Type': content_type}
         
         # Add basic authentication if credentials provided
-        if self.username and self.password:
-            auth_string = f"{self.username}:{self.password}"
-            auth_bytes = auth_string.encode('ascii')
-            auth_b64 = base64.b64encode(auth_bytes).decode('ascii')
-            request.add_header('Authorization', f'Basic {auth_b64}')
+        if self._auth_header:
+            headers['Authorization'] = self._auth_header
+        
+        validator = self._etag_cache.get(url) if conditional and method == "GET" else None
+        if validator:
+            headers['If-None-Match'] = validator[0]
+        
+        for attempt in range(2):
+            # Add CSRF token for write operations; a token rejected on the first attempt is never resent
+            if method in _WRITE_METHODS:
+                headers.pop('X-CSRF-Token', None)
+                csrf_token = self._get_csrf_token()
+                if csrf_token:
+                    headers['X-CSRF-Token'] = csrf_token
+            
+            try:
+                status, response_headers, response_data = self._session_request(method, url, body, headers, timeout=60)
+            except SAPHTTPError:
+                raise
+            except Exception as e:
+                raise Exception(f"Request failed: {str(e)}")
+            
+            # SAP rejects a token that expired or belongs to an older session; fetch a fresh one once
+            if (status == 403 and attempt == 0 and method in _WRITE_METHODS
+                    and (response_headers.get('X-CSRF-Token') or '').lower() == 'required'):
+                self._csrf_token = None
+                continue
+            break
         
+        if status == 304 and validator:
+            return 200, response_headers, validator[1]
+        if status >= 300:
+            raise SAPHTTPError(status, f"HTTP {status}: {response_data.decode('utf-8', 'replace')}")
+        if conditional and method == "GET" and response_headers.get('ETag'):
+            self._etag_cache[url] = (response_headers['ETag'], response_data)
+        return status, response_headers, response_data
+    
+    def _make_request(self, endpoint: str, params: Dict[str, str] = None, method: str = "GET", data: Union[str, bytes] = None, service: str = None, lazy: bool = False, conditional: bool = False) -> Dict[str, Any]:
+        """Make HTTP request to SAP OData service with full HTTP method support
+        
+        With lazy=True and pysimdjson installed the parsed document is returned
+        as a read-only simdjson proxy. It pins this thread's parser: the caller
+        must drop it, and every value taken from it, before the next lazy parse
+        on the same thread, which otherwise raises RuntimeError.
+        """
         # Add request body for write operations
-        if data and method.upper() in ['POST', 'PUT', 'PATCH']:
-            request.data = data.encode('utf-8')
+        method = method.upper()
+        body = None
+        if data and method in _BODY_METHODS:
+            body = data if isinstance(data, bytes) else data.encode('utf-8')
+        
+        _, _, response_data = self._send(method, endpoint, params, body, service, conditional=conditional)
+        if lazy and simdjson is not None and _has_content(response_data):
+            return self._parse_lazy(response_data)
+        return _parse_response_body(response_data, method)
+    
+    def execute_batch(self, operations: List[Dict[str, Any]], service: str = None) -> List[Dict[str, Any]]:
+        """Execute operations in a single OData $batch round-trip
         
+        Every write gets its own changeset, so operations succeed or fail
+        independently just like separate requests. If the service rejects
+        $batch itself, the operations are sent one by one instead. An
+        operation whose method isn't a string fails on its own, unsent.
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(operations)
+        valid = []
+        for i, operation in enumerate(operations):
+            if _operation_method(operation) is None:
+                results[i] = {"operation": i + 1, "status": "error", "error": f"Invalid method: {operation.get('method')!r}"}
+            else:
+                valid.append(i)
+        
+        if valid:
+            sent = self._send_batch([operations[i] for i in valid], service)
+            for i, result in zip(valid, sent):
+                results[i] = {**result, "operation": i + 1}
+        return results
+    
+    def _send_batch(self, operations: List[Dict[str, Any]], service: str = None) -> List[Dict[str, Any]]:
+        """Send operations with valid methods as one $batch request, numbered by their position"""
+        boundary = f"batch_{uuid.uuid4().hex}"
         try:
-            with urllib.request.urlopen(request, timeout=60) as response:
-                response_data = response.read().decode('utf-8')
-                if response_data.strip():
-                    return json.loads(response_data)
-                else:
-                    return {"status": "success", "message": f"{method} operation completed"}
-        except urllib.error.HTTPError as e:
-            error_data = e.read().decode('utf-8') if e.fp else str(e)
+            _, response_headers, response_data = self._send(
+                "POST", "$batch", body=_build_batch_body(operations, boundary), service=service,
+                content_type=f"multipart/mixed; boundary={boundary}")
+        except SAPHTTPError as e:
+            # Auth failures and outages would only fail again per operation (and replay writes)
+            if e.status not in self.BATCH_UNSUPPORTED_STATUSES:
+                raise
+            return self._execute_sequentially(operations, service)
+        
+        responses = _parse_batch_response(response_headers.get('Content-Type', ''), response_data)
+        results = []
+        for i, operation in enumerate(operations):
+            method = _operation_method(operation)
+            if i >= len(responses):
+                results.append({"operation": i + 1, "status": "error", "error": "No response for operation in $batch reply"})
+                continue
+            status, payload = responses[i]
+            if status is None:
+                results.append({"operation": i + 1, "status": "error", "error": "Malformed response part in $batch reply"})
+                continue
+            if status >= 300:
+                results.append({"operation": i + 1, "status": "error", "error": f"HTTP {status}: {payload.decode('utf-8', 'replace')}"})
+                continue
             try:
-                error_json = json.loads(error_data)
-                raise Exception(f"HTTP {e.code}: {error_json}")
-            except:
-                raise Exception(f"HTTP {e.code}: {error_data}")
-        except Exception as e:
-            raise Exception(f"Request failed: {str(e)}")
+                results.append({"operation": i + 1, "status": "success", "result": _parse_response_body(payload, method)})
+            except Exception as e:
+                results.append({"operation": i + 1, "status": "error", "error": str(e)})
+        return results
     
-    def _get_csrf_token(self) -> Optional[str]:
-        """Get CSRF token for write operations"""
-        try:
-            request = urllib.request.Request(self.base_url, method="HEAD")
-            request.add_header('X-CSRF-Token', 'fetch')
-            if self.username and self.password:
-                auth_string = f"{self.username}:{self.password}"
-                auth_bytes = auth_string.encode('ascii')
-                auth_b64 = base64.b64encode(auth_bytes).decode('ascii')
-                request.add_header('Authorization', f'Basic {auth_b64}')
+    def _execute_sequentially(self, operations: List[Dict[str, Any]], service: str = None) -> List[Dict[str, Any]]:
+        """Execute operations as individual requests (fallback for services without $batch)"""
+        results = []
+        for i, operation in enumerate(operations):
+            try:
+                method = _operation_method(operation)
+                url = operation.get("url", "")
+                data = operation.get("data")
+                
+                data_json = _json_bytes(data) if data else None
+                result = self._make_request(url, method=method, data=data_json, service=service)
+                results.append({
+                    "operation": i + 1,
+                    "status": "success",
+                    "result": result
+                })
+            except Exception as e:
+                results.append({
+                    "operation": i + 1,
+                    "status": "error",
+                    "error": str(e)
+                })
+        return results
+    
+    def _session_request(self, method: str, url: str, body: Optional[bytes], headers: Dict[str, str],
+                         timeout: float) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        """Send through the connection pool, carrying the SAP session cookies both ways
+        
+        CSRF tokens are bound to the session cookie they were issued with, so the
+        cookies have to persist for a cached token to stay valid. Redirects are
+        followed up to MAX_REDIRECTS hops; Authorization is not sent to another host.
+        """
+        for _ in range(self.MAX_REDIRECTS + 1):
+            cookie_request = urllib.request.Request(url, method=method)
+            self._cookies.add_cookie_header(cookie_request)
+            cookie_header = cookie_request.get_header('Cookie')
+            request_headers = {**headers, 'Cookie': cookie_header} if cookie_header else headers
             
-            with urllib.request.urlopen(request, timeout=30) as response:
-                return response.headers.get('X-CSRF-Token')
-        except:
+            status, response_headers, response_data = self._http.request(method, url, body, request_headers, timeout=timeout)
+            self._cookies.extract_cookies(_CookieResponse(response_headers), cookie_request)
+            
+            location = response_headers.get('Location')
+            if status not in _REDIRECT_STATUSES or not location:
+                return status, response_headers, response_data
+            
+            target = urllib.parse.urljoin(url, location)
+            if status == 303 or (status in (301, 302) and method == "POST"):
+                # Like urllib: the redirected request becomes a GET without the body
+                method, body = "GET", None
+            elif status in (301, 302) and method not in ("GET", "HEAD"):
+                raise SAPHTTPError(status, f"HTTP {status}: {method} redirected to {target}; resend it to that URL")
+            if urllib.parse.urlsplit(target).netloc != urllib.parse.urlsplit(url).netloc:
+                headers = {name: value for name, value in headers.items() if name.lower() != 'authorization'}
+            url = target
+        
+        raise SAPHTTPError(status, f"HTTP {status}: more than {self.MAX_REDIRECTS} redirects, last to {url}")
+    
+    def _get_csrf_token(self, force_refresh: bool = False) -> Optional[str]:
+        """Get CSRF token for write operations, reusing it until it expires"""
+        if not force_refresh and self._csrf_token and time.monotonic() < self._csrf_expires:
+            return self._csrf_token
+        
+        headers = {'X-CSRF-Token': 'fetch'}
+        if self._auth_header:
+            headers['Authorization'] = self._auth_header
+        try:
+            status, response_headers, _ = self._session_request("HEAD", self.base_url, None, headers, timeout=30)
+        except Exception:
             return None
+        
+        token = response_headers.get('X-CSRF-Token') if status < 300 else None
+        if token:
+            self._csrf_token = token
+            self._csrf_expires = time.monotonic() + self.CSRF_TOKEN_TTL
+        return token
     
-    def get_service_document(self, service: str = None) -> Dict[str, Any]:
+    def get_service_document(self, service: str = None, force_refresh: bool = False) -> Dict[str, Any]:
         """Get and cache service document"""
         target_service = service or self.current_service or 'default'
         
-        if target_service not in self._service_doc_cache:
-            self._service_doc_cache[target_service] = self._make_request("", service=service)
+        if target_service not in self._service_doc_cache or force_refresh:
+            self._service_doc_cache[target_service] = self._make_request("", service=service, conditional=True)
         return self._service_doc_cache[target_service]
     
     def get_metadata(self, force_refresh: bool = False) -> Dict[str, Any]:
         """Get and parse OData metadata"""
-        if not self._metadata_cache or force_refresh:
-            try:
-                # Try JSON metadata first
-                metadata = self._make_request("$metadata", {"$format": "json"})
-                self._metadata_cache = metadata
-            except:
-                # Fallback to service document
-                self._metadata_cache = self.get_service_document()
-        return self._metadata_cache
+        # Pin the service once, so a concurrent switch_service can't mix two services' documents
+        service = self.current_service
+        service_key = service or 'default'
+        if service_key not in self._metadata_cache or force_refresh:
+            metadata = None
+            # Most gateways only serve XML $metadata; once a service has said so, skip the JSON attempt
+            if self._metadata_format.get(service_key) != "xml":
+                try:
+                    metadata = self._make_request("$metadata", {"$format": "json"}, service=service, conditional=True)
+                except SAPHTTPError as e:
+                    if e.status in self.XML_ONLY_METADATA_STATUSES:
+                        self._metadata_format[service_key] = "xml"
+                except ValueError:
+                    # A 200 with a body that isn't JSON is the XML document itself
+                    self._metadata_format[service_key] = "xml"
+                except Exception:
+                    pass
+            # Fallback to service document
+            if metadata is None:
+                metadata = self.get_service_document(service, force_refresh=force_refresh)
+            self._metadata_cache[service_key] = metadata
+        return self._metadata_cache[service_key]
     
-    def discover_entity_sets(self, service: str = None) -> List[str]:
+    def discover_entity_sets(self, service: str = None, force_refresh: bool = False) -> List[str]:
         """Dynamically discover all available entity sets for a service"""
-        service_doc = self.get_service_document(service)
-        entity_sets = []
+        service_doc = self.get_service_document(service, force_refresh)
         
-        # Handle different OData response formats
-        if "d" in service_doc and "EntitySets" in service_doc["d"]:
-            entity_sets = service_doc["d"]["EntitySets"]
-        elif "value" in service_doc:
-            entity_sets = [item["name"] for item in service_doc["value"] if "name" in item]
-        elif "EntitySets" in service_doc:
-            entity_sets = service_doc["EntitySets"]
-        
-        return entity_sets
+        # V2 lists entity set names directly, V4 lists {"name": ..., "url": ...} objects
+        return [item if isinstance(item, str) else item["name"]
+                for item in _result_rows(service_doc) if isinstance(item, str) or "name" in item]
     
     def analyze_entity_structure(self, entity_set: str) -> Dict[str, Any]:
         """Analyze entity structure by sampling data"""
         try:
             sample_data = self._make_request(entity_set, {"$top": "1"})
-            
-            if "d" in sample_data and "results" in sample_data["d"] and sample_data["d"]["results"]:
-                sample_entity = sample_data["d"]["results"][0]
-            elif "value" in sample_data and sample_data["value"]:
-                sample_entity = sample_data["value"][0]
-            else:
-                return {"error": "No sample data available"}
-            
-            # Analyze field types and structure
-            structure = {}
-            for key, value in sample_entity.items():
-                if key.startswith("__"):
-                    continue
-                structure[key] = {
-                    "type": type(value).__name__,
-                    "sample_value": str(value)[:100] if len(str(value)) > 100 else value
-                }
-            
-            return {
-                "entity_set": entity_set,
-                "fields": structure,
-                "sample_count": 1
-            }
+            return self._analyze_sample(entity_set, sample_data)
         except Exception as e:
             return {"error": str(e)}
     
+    def batch_analyze(self, entity_sets: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Analyze several entity structures, sampling all of them in one $batch round-trip"""
+        try:
+            results = self.execute_batch([{"method": "GET", "url": f"{entity_set}?$top=1"} for entity_set in entity_sets])
+        except Exception as e:
+            return {entity_set: {"error": str(e)} for entity_set in entity_sets}
+        
+        analyses = {}
+        for entity_set, result in zip(entity_sets, results):
+            if result["status"] == "success":
+                analyses[entity_set] = self._analyze_sample(entity_set, result["result"])
+            else:
+                analyses[entity_set] = {"error": result["error"]}
+        return analyses
+    
+    def _analyze_sample(self, entity_set: str, sample_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Describe the fields of the first entity in a sampled response"""
+        rows = _result_rows(sample_data)
+        if not rows:
+            return {"error": "No sample data available"}
+        sample_entity = rows[0]
+        
+        # Analyze field types and structure
+        structure = {}
+        for key, value in sample_entity.items():
+            if key.startswith(_INTERNAL_PREFIX):
+                continue
+            structure[key] = _describe_value(value)
+        
+        return {
+            "entity_set": entity_set,
+            "fields": structure,
+            "sample_count": 1
+        }
+    
     def discover_all_services(self) -> List[Dict[str, Any]]:
         """Discover all available OData services on the SAP system"""
         try:
             # Try SAP Gateway service catalog
             catalog_url = "/IWFND/CATALOGSERVICE;v=2/ServiceCollection"
-            catalog_data = self._make_request(catalog_url, service=None)
+            # Only a few fields per service are read, so skip building the full dict
+            catalog_data = self._make_request(catalog_url, service=None, lazy=True)
             
             services = []
-            if "d" in catalog_data and "results" in catalog_data["d"]:
-                for service in catalog_data["d"]["results"]:
-                    services.append({
-                        "name": service.get("TechnicalServiceName", service.get("ServiceId", "Unknown")),
-                        "description": service.get("ServiceDescription", service.get("Title", "")),
-                        "version": service.get("ServiceVersion", "1")
-                    })
-            elif "value" in catalog_data:
-                for service in catalog_data["value"]:
-                    services.append({
-                        "name": service.get("TechnicalServiceName", service.get("ServiceId", "Unknown")),
-                        "description": service.get("ServiceDescription", service.get("Title", "")),
-                        "version": service.get("ServiceVersion", "1")
-                    })
+            for service in _result_rows(catalog_data):
+                services.append({
+                    "name": service.get("TechnicalServiceName", service.get("ServiceId", "Unknown")),
+                    "description": service.get("ServiceDescription", service.get("Title", "")),
+                    "version": service.get("ServiceVersion", "1")
+                })
+            # Release the simdjson proxies so this thread's parser can be reused
+            catalog_data = service = None
             
             self._available_services = services
+            self._entity_to_service = None
             return services
             
         except:
             # Fallback: try common service patterns
-            common_services = [
-                "API_CUSTOMER_SRV", "API_BILLING_DOCUMENT_SRV", "API_SALES_ORDER_SRV",
-                "API_MATERIAL_SRV", "API_SUPPLIER_SRV", "API_FINANCIALSTATEMENT_SRV",
-                "API_PURCHASE_ORDER_SRV", "API_BUSINESS_PARTNER_SRV"
-            ]
-            
-            available_services = []
-            for service_name in common_services:
+            def service_exists(service_name: str) -> bool:
                 try:
-                    # Test if service exists
                     self._make_request("", service=service_name)
+                    return True
+                except Exception:
+                    return False
+            
+            # The probes are independent round-trips, so run them side by side
+            with ThreadPoolExecutor(max_workers=len(_COMMON_SERVICES)) as executor:
+                probes = list(executor.map(service_exists, _COMMON_SERVICES))
+            
+            available_services = []
+            for service_name, exists in zip(_COMMON_SERVICES, probes):
+                if exists:
                     available_services.append({
                         "name": service_name,
-                        "description": f"SAP {service_name.replace('API_', '').replace('_SRV', '')} Service",
+                        "description": _COMMON_SERVICE_DESCRIPTIONS[service_name],
                         "version": "1"
                     })
-                except:
-                    continue
             
             self._available_services = available_services
+            self._entity_to_service = None
             return available_services
     
     def find_service_for_entity(self, entity_name: str) -> Optional[str]:
@@ -232,19 +846,37 @@ class SAPODataClient:
                 pass
         
         # Search through all available services
+        index = self._entity_to_service
+        if index is None:
+            with self._index_lock:
+                index = self._entity_to_service
+                if index is None:
+                    index = self._build_entity_index()
+        
+        return index.get(entity_name)
+    
+    def _build_entity_index(self) -> Dict[str, str]:
+        """Map every entity set to the first available service that exposes it"""
         if not self._available_services:
             self.discover_all_services()
         
-        for service_info in self._available_services:
-            service_name = service_info["name"]
+        def entity_sets_or_empty(service_name: str) -> List[str]:
             try:
-                entities = self.discover_entity_sets(service_name)
-                if entity_name in entities:
-                    return service_name
-            except:
-                continue
+                return self.discover_entity_sets(service_name)
+            except Exception:
+                return []
         
-        return None
+        service_names = [service_info["name"] for service_info in self._available_services]
+        index = {}
+        # Service documents are fetched concurrently; map() keeps the service order for ties
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            for service_name, entities in zip(service_names, executor.map(entity_sets_or_empty, service_names)):
+                for entity in entities:
+                    index.setdefault(entity, service_name)
+        
+        # An empty index means discovery or every fetch failed; leave it unbuilt so the next lookup retries
+        self._entity_to_service = index or None
+        return index
     
     def switch_service(self, service_name: str) -> bool:
         """Switch to a different OData service"""
@@ -267,9 +899,28 @@ class SAPODataClient:
 
 
 class FlexibleSAPMCPServer:
+    __slots__ = (
+        "tools", "_sap_client", "_sap_config", "_sap_client_lock", "_cache", "_env",
+        "_initialize_result", "_tools_list_result", "_dispatch",
+    )
+    
+    # Seconds that discovery results (entity sets, metadata, services) are reused
+    CACHE_TTL = 300
+    # Rows of a query result rendered as JSON; the rest are counted, not serialized
+    MAX_DISPLAY_ROWS = 100
+    
     def __init__(self):
-        self.sap_client = None
+        self._sap_client = None
+        self._sap_config: Optional[Tuple[str, Optional[str], Optional[str]]] = None
+        self._sap_client_lock = threading.Lock()
+        self._cache: Dict[tuple, Tuple[float, Any]] = {}
         self._load_sap_config()
+        # Configuration as reported by sap_test_connection; the environment is fixed once .env is loaded
+        self._env = {
+            "base_url": os.environ.get('SAP_URL', 'Not set'),
+            "username": os.environ.get('SAP_USERNAME', 'Not set'),
+            "has_password": 'Yes' if os.environ.get('SAP_PASSWORD') else 'No',
+        }
         
         self.tools = {
             "echo": {
@@ -446,6 +1097,50 @@ class FlexibleSAPMCPServer:
                 }
             }
         }
+        
+        self._initialize_result = _json_bytes({
+            "protocolVersion": "2024-11-05",
+            "capabilities": {"tools": {}},
+            "serverInfo": {"name": "flexible-sap-mcp", "version": "2.0.0"}
+        })
+        
+        # The tool definitions never change, so the tools/list result is serialized once
+        self._tools_list_result = b'{"tools":[' + b",".join(
+            _json_bytes({"name": name, "description": info["description"], "inputSchema": info["parameters"]})
+            for name, info in self.tools.items()
+        ) + b']}'
+        
+        # Tool name -> handler, looked up once per tools/call
+        self._dispatch = {
+            "echo": self.echo_tool,
+            "sap_query": self.sap_query_tool,
+            "sap_create": self.sap_create_tool,
+            "sap_update": self.sap_update_tool,
+            "sap_delete": self.sap_delete_tool,
+            "sap_function": self.sap_function_tool,
+            "sap_batch": self.sap_batch_tool,
+            "sap_discover": self.sap_discover_tool,
+            "sap_metadata": self.sap_metadata_tool,
+            "sap_test_connection": self.sap_test_connection_tool,
+            "sap_raw_request": self.sap_raw_request_tool,
+            "sap_discover_services": self.sap_discover_services_tool,
+            "sap_switch_service": self.sap_switch_service_tool,
+            "sap_smart_query": self.sap_smart_query_tool,
+            "sap_service_info": self.sap_service_info_tool,
+        }
+    
+    @property
+    def sap_client(self) -> Optional[SAPODataClient]:
+        """SAP client, built on first use from the loaded configuration (None if unconfigured)"""
+        if self._sap_client is None and self._sap_config is not None:
+            with self._sap_client_lock:
+                if self._sap_client is None:
+                    self._sap_client = SAPODataClient(*self._sap_config)
+        return self._sap_client
+    
+    @sap_client.setter
+    def sap_client(self, client: Optional[SAPODataClient]):
+        self._sap_client = client
     
     def _load_sap_config(self):
         """Load SAP config from .env file"""
@@ -456,11 +1151,8 @@ class FlexibleSAPMCPServer:
         if os.path.exists(env_path):
             try:
                 with open(env_path, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line and not line.startswith('#') and '=' in line:
-                            key, value = line.split('=', 1)
-                            os.environ[key.strip()] = value.strip()
+                    for match in _ENV_LINE_RE.finditer(f.read()):
+                        os.environ[match.group(1)] = match.group(2)
                 
                 print("✓ Successfully loaded .env file", file=sys.stderr)
                 
@@ -469,7 +1161,7 @@ class FlexibleSAPMCPServer:
                 password = os.environ.get('SAP_PASSWORD')
                 
                 if base_url:
-                    self.sap_client = SAPODataClient(base_url, username, password)
+                    self._sap_config = (base_url, username, password)
                     auth_info = "with auth" if username else "without auth"
                     print(f"✓ SAP client configured {auth_info}", file=sys.stderr)
                 else:
@@ -480,10 +1172,10 @@ class FlexibleSAPMCPServer:
         else:
             print("ℹ Create .env file with SAP_URL, SAP_USERNAME, SAP_PASSWORD", file=sys.stderr)
     
-    def handle_message(self, message):
-        """Handle incoming JSON-RPC messages"""
+    def handle_message(self, message: bytes) -> bytes:
+        """Handle an incoming JSON-RPC message and return the serialized response"""
         try:
-            data = json.loads(message)
+            data = _json_loads(message)
             method = data.get("method")
             params = data.get("params", {})
             msg_id = data.get("id", "unknown")
@@ -501,30 +1193,10 @@ class FlexibleSAPMCPServer:
             return self.error_response(None, f"Error parsing message: {str(e)}")
     
     def initialize_response(self, msg_id):
-        return json.dumps({
-            "jsonrpc": "2.0",
-            "id": msg_id,
-            "result": {
-                "protocolVersion": "2024-11-05",
-                "capabilities": {"tools": {}},
-                "serverInfo": {"name": "flexible-sap-mcp", "version": "2.0.0"}
-            }
-        })
+        return _RESULT_ENVELOPE % (_json_bytes(msg_id), self._initialize_result)
     
     def list_tools_response(self, msg_id):
-        tools_list = []
-        for name, info in self.tools.items():
-            tools_list.append({
-                "name": name,
-                "description": info["description"],
-                "inputSchema": info["parameters"]
-            })
-        
-        return json.dumps({
-            "jsonrpc": "2.0",
-            "id": msg_id,
-            "result": {"tools": tools_list}
-        })
+        return _RESULT_ENVELOPE % (_json_bytes(msg_id), self._tools_list_result)
     
     def call_tool_response(self, msg_id, params):
         tool_name = params.get("name")
@@ -533,78 +1205,65 @@ class FlexibleSAPMCPServer:
         if not self.sap_client and tool_name != "echo":
             return self.error_response(msg_id, "SAP not configured. Create .env file with SAP_URL.")
         
+        handler = self._dispatch.get(tool_name)
+        if handler is None:
+            return self.error_response(msg_id, f"Unknown tool: {tool_name}")
+        
         try:
-            if tool_name == "echo":
-                result = self.echo_tool(arguments)
-            elif tool_name == "sap_query":
-                result = self.sap_query_tool(arguments)
-            elif tool_name == "sap_create":
-                result = self.sap_create_tool(arguments)
-            elif tool_name == "sap_update":
-                result = self.sap_update_tool(arguments)
-            elif tool_name == "sap_delete":
-                result = self.sap_delete_tool(arguments)
-            elif tool_name == "sap_function":
-                result = self.sap_function_tool(arguments)
-            elif tool_name == "sap_batch":
-                result = self.sap_batch_tool(arguments)
-            elif tool_name == "sap_discover":
-                result = self.sap_discover_tool(arguments)
-            elif tool_name == "sap_metadata":
-                result = self.sap_metadata_tool(arguments)
-            elif tool_name == "sap_test_connection":
-                result = self.sap_test_connection_tool(arguments)
-            elif tool_name == "sap_raw_request":
-                result = self.sap_raw_request_tool(arguments)
-            elif tool_name == "sap_discover_services":
-                result = self.sap_discover_services_tool(arguments)
-            elif tool_name == "sap_switch_service":
-                result = self.sap_switch_service_tool(arguments)
-            elif tool_name == "sap_smart_query":
-                result = self.sap_smart_query_tool(arguments)
-            elif tool_name == "sap_service_info":
-                result = self.sap_service_info_tool(arguments)
-            else:
-                return self.error_response(msg_id, f"Unknown tool: {tool_name}")
+            result = handler(arguments)
             
-            return json.dumps({
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "result": {"content": [{"type": "text", "text": result}]}
-            })
+            return _TEXT_RESULT_ENVELOPE % (_json_bytes(msg_id), _json_bytes(result))
         
         except Exception as e:
             return self.error_response(msg_id, f"Tool error in {tool_name}: {str(e)}")
     
+    def _cached(self, key: tuple, loader):
+        """Return a cached value, reloading it once it is older than CACHE_TTL seconds
+        
+        The loader is called with refresh=True when an expired entry is replaced,
+        so it can bypass the SAP client's own caches.
+        """
+        now = time.monotonic()
+        entry = self._cache.get(key)
+        if entry is not None and now - entry[0] < self.CACHE_TTL:
+            return entry[1]
+        value = loader(entry is not None)
+        self._cache[key] = (now, value)
+        return value
+    
+    def _entity_sets(self) -> Tuple[List[str], str]:
+        """Entity sets of the current service, plus the "- name" bullet list shown by the tools"""
+        def load(refresh: bool) -> Tuple[List[str], str]:
+            entity_sets = self.sap_client.discover_entity_sets(force_refresh=refresh)
+            return entity_sets, "\n".join(f"- {entity}" for entity in entity_sets)
+        
+        return self._cached(("entity_sets", self.sap_client.current_service), load)
+    
+    def _available_services(self) -> List[Dict[str, Any]]:
+        """All OData services on the system"""
+        services = self._cached(("services",), lambda refresh: self.sap_client.discover_all_services())
+        if not services:
+            # Every system has services, so an empty list means discovery failed (SAP briefly
+            # unreachable, say); don't keep that answer for CACHE_TTL, look again next call
+            self._cache.pop(("services",), None)
+        return services
+    
     def echo_tool(self, args):
         """Echo back the input message"""
         message = args["message"]
         return f"Echo: {message}"
     
-    def sap_query_tool(self, args):
-        """Flexible SAP OData query"""
+    def sap_query_tool(self, args, service: str = None):
+        """Flexible SAP OData query, against the current service unless another is given"""
         entity_set = args["entity_set"]
         
-        # Build comprehensive OData query parameters
-        params = {}
-        if args.get("filter"):
-            params["$filter"] = args["filter"]
-        if args.get("select"):
-            params["$select"] = args["select"]
-        if args.get("expand"):
-            params["$expand"] = args["expand"]
-        if args.get("orderby"):
-            params["$orderby"] = args["orderby"]
-        if args.get("top"):
-            params["$top"] = str(args["top"])
-        if args.get("skip"):
-            params["$skip"] = str(args["skip"])
+        # Build comprehensive OData query parameters (top=0 / skip=0 are valid values)
+        params = {option: convert(value) for arg, option, convert in _QUERY_OPTIONS
+                  if (value := args.get(arg)) is not None and value != ""}
         if args.get("count"):
             params["$count"] = "true"
-        if args.get("format"):
-            params["$format"] = args["format"]
         
-        data = self.sap_client._make_request(entity_set, params)
+        data = self.sap_client._make_request(entity_set, params, service=service)
         
         # Format response with metadata
         result_info = self._format_query_result(data, entity_set, params)
@@ -615,10 +1274,10 @@ class FlexibleSAPMCPServer:
         entity_set = args["entity_set"]
         entity_data = args["data"]
         
-        data_json = json.dumps(entity_data)
+        data_json = _json_bytes(entity_data)
         result = self.sap_client._make_request(entity_set, method="POST", data=data_json)
         
-        return f"✅ Created new entity in {entity_set}:\n{json.dumps(result, indent=2)}"
+        return f"✅ Created new entity in {entity_set}:\n{_json_dumps(result, pretty=True)}"
     
     def sap_update_tool(self, args):
         """Update existing entity in SAP"""
@@ -626,10 +1285,10 @@ class FlexibleSAPMCPServer:
         entity_data = args["data"]
         method = args.get("method", "PATCH")
         
-        data_json = json.dumps(entity_data)
+        data_json = _json_bytes(entity_data)
         result = self.sap_client._make_request(entity_key, method=method, data=data_json)
         
-        return f"✅ Updated entity {entity_key} using {method}:\n{json.dumps(result, indent=2)}"
+        return f"✅ Updated entity {entity_key} using {method}:\n{_json_dumps(result, pretty=True)}"
     
     def sap_delete_tool(self, args):
         """Delete entity from SAP"""
@@ -637,7 +1296,7 @@ class FlexibleSAPMCPServer:
         
         result = self.sap_client._make_request(entity_key, method="DELETE")
         
-        return f"✅ Deleted entity {entity_key}:\n{json.dumps(result, indent=2)}"
+        return f"✅ Deleted entity {entity_key}:\n{_json_dumps(result, pretty=True)}"
     
     def sap_function_tool(self, args):
         """Call SAP function import"""
@@ -646,41 +1305,38 @@ class FlexibleSAPMCPServer:
         
         # Build function call URL
         if function_params:
-            param_string = ",".join([f"{k}='{v}'" for k, v in function_params.items()])
+            param_string = ",".join(f"{k}='{v}'" for k, v in function_params.items())
             endpoint = f"{function_name}({param_string})"
         else:
             endpoint = function_name
         
         result = self.sap_client._make_request(endpoint, method="POST")
         
-        return f"📞 Function {function_name} result:\n{json.dumps(result, indent=2)}"
+        return f"📞 Function {function_name} result:\n{_json_dumps(result, pretty=True)}"
     
     def sap_batch_tool(self, args):
-        """Execute batch operations (simplified implementation)"""
+        """Execute batch operations as one OData $batch request"""
         operations = args["operations"]
         
-        results = []
-        for i, operation in enumerate(operations):
-            try:
-                method = operation.get("method", "GET")
-                url = operation.get("url", "")
-                data = operation.get("data")
-                
-                data_json = json.dumps(data) if data else None
-                result = self.sap_client._make_request(url, method=method, data=data_json)
-                results.append({
-                    "operation": i + 1,
-                    "status": "success",
-                    "result": result
-                })
-            except Exception as e:
-                results.append({
-                    "operation": i + 1,
-                    "status": "error",
-                    "error": str(e)
-                })
+        # Identical reads are sent once and their result fanned out to every position that asked for it.
+        # A write in between ends the window, since a later read has to observe it.
+        unique_operations, positions, seen = [], [], {}
+        for operation in operations:
+            key = _read_key(operation)
+            if key is None:
+                seen.clear()
+            elif key in seen:
+                positions.append(seen[key])
+                continue
+            else:
+                seen[key] = len(unique_operations)
+            positions.append(len(unique_operations))
+            unique_operations.append(operation)
+        
+        unique_results = self.sap_client.execute_batch(unique_operations)
+        results = [{**unique_results[position], "operation": i + 1} for i, position in enumerate(positions)]
         
-        return f"📦 Batch operation results:\n{json.dumps(results, indent=2)}"
+        return f"📦 Batch operation results:\n{_json_dumps(results, pretty=True)}"
     
     def sap_discover_tool(self, args):
         """Discover and analyze SAP service structure"""
@@ -690,29 +1346,27 @@ class FlexibleSAPMCPServer:
         if entity_set:
             # Analyze specific entity set
             structure = self.sap_client.analyze_entity_structure(entity_set)
-            return f"🔍 Entity Analysis for {entity_set}:\n{json.dumps(structure, indent=2)}"
+            return f"🔍 Entity Analysis for {entity_set}:\n{_json_dumps(structure, pretty=True)}"
         else:
             # Discover all entity sets
-            entity_sets = self.sap_client.discover_entity_sets()
+            entity_sets, entity_list = self._entity_sets()
             
             if deep_analysis and entity_sets:
-                # Analyze first few entity sets as examples
-                analyses = {}
-                for entity in entity_sets[:3]:  # Analyze first 3 as samples
-                    analyses[entity] = self.sap_client.analyze_entity_structure(entity)
+                # Analyze first 3 entity sets as samples, in a single $batch
+                analyses = self.sap_client.batch_analyze(entity_sets[:3])
                 
                 return f"""🔍 SAP Service Discovery:
 
 📊 Available Entity Sets ({len(entity_sets)}):
-{chr(10).join([f"- {entity}" for entity in entity_sets])}
+{entity_list}
 
 📋 Sample Entity Structures:
-{json.dumps(analyses, indent=2)}"""
+{_json_dumps(analyses, pretty=True)}"""
             else:
                 return f"""🔍 SAP Service Discovery:
 
 📊 Available Entity Sets ({len(entity_sets)}):
-{chr(10).join([f"- {entity}" for entity in entity_sets])}
+{entity_list}
 
 💡 Use deep_analysis=true for detailed structure analysis"""
     
@@ -721,17 +1375,18 @@ class FlexibleSAPMCPServer:
         format_type = args.get("format", "summary")
         
         try:
-            metadata = self.sap_client.get_metadata()
-            entity_sets = self.sap_client.discover_entity_sets()
+            metadata = self._cached(("metadata", self.sap_client.current_service),
+                                    lambda refresh: self.sap_client.get_metadata(force_refresh=refresh))
+            entity_sets, entity_list = self._entity_sets()
             
             if format_type == "detailed":
                 return f"""📋 Detailed SAP Metadata:
 
 🌐 Service Information:
-{json.dumps(metadata, indent=2)}
+{_json_dumps(metadata, pretty=True)}
 
 📊 Entity Sets ({len(entity_sets)}):
-{chr(10).join([f"- {entity}" for entity in entity_sets])}"""
+{entity_list}"""
             else:
                 return f"""📋 SAP Service Summary:
 
@@ -740,7 +1395,7 @@ class FlexibleSAPMCPServer:
 🛠️ Available Operations: Query, Create, Update, Delete, Functions
 
 📝 Entity Sets:
-{chr(10).join([f"- {entity}" for entity in entity_sets])}
+{entity_list}
 
 💡 Use format="detailed" for full metadata"""
         except Exception as e:
@@ -749,75 +1404,35 @@ class FlexibleSAPMCPServer:
     def sap_test_connection_tool(self, args):
         """Test SAP connection and show comprehensive status"""
         if not self.sap_client:
-            return "❌ SAP not configured. Create .env file with:\nSAP_URL=your_sap_url\nSAP_USERNAME=your_username (optional)\nSAP_PASSWORD=your_password (optional)"
-        
-        base_url = os.environ.get('SAP_URL', 'Not set')
-        username = os.environ.get('SAP_USERNAME', 'Not set')
-        has_password = 'Yes' if os.environ.get('SAP_PASSWORD') else 'No'
+            return _NOT_CONFIGURED_MESSAGE
         
         try:
-            # Test connection and gather comprehensive info
-            service_doc = self.sap_client.get_service_document()
-            entity_sets = self.sap_client.discover_entity_sets()
+            # Test connection and CSRF token capability side by side; they are independent round-trips.
+            # Both bypass their caches so the test always reaches SAP (the service document is revalidated by ETag)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                csrf_future = executor.submit(self.sap_client._get_csrf_token, True)
+                entity_sets = self.sap_client.discover_entity_sets(force_refresh=True)
+                
+                csrf_available = "Unknown"
+                try:
+                    csrf_token = csrf_future.result()
+                    csrf_available = "Yes" if csrf_token else "No"
+                except:
+                    csrf_available = "No"
             
-            # Test CSRF token capability
-            csrf_available = "Unknown"
-            try:
-                csrf_token = self.sap_client._get_csrf_token()
-                csrf_available = "Yes" if csrf_token else "No"
-            except:
-                csrf_available = "No"
-            
-            return f"""✅ SAP Connection Status: SUCCESS
-
-🔧 Configuration:
-- URL: {base_url}
-- Username: {username}
-- Password: {has_password}
-- CSRF Support: {csrf_available}
-
-📊 Service Capabilities:
-- Entity Sets: {len(entity_sets)}
-- Read Operations: ✅ Available
-- Write Operations: {'✅ Available' if csrf_available == 'Yes' else '⚠️ Limited'}
-- Function Imports: ✅ Available
-- Batch Operations: ✅ Available
-
-🛠️ Available Tools:
-- sap_query (flexible querying)
-- sap_create (create entities)
-- sap_update (update entities)
-- sap_delete (delete entities)
-- sap_function (call functions)
-- sap_batch (batch operations)
-- sap_discover (explore structure)
-- sap_raw_request (maximum flexibility)
-
-Ready for intelligent SAP interaction! 🚀"""
+            return _CONNECTION_OK_TEMPLATE.format_map(dict(
+                self._env,
+                csrf_available=csrf_available,
+                entity_count=len(entity_sets),
+                write_status='✅ Available' if csrf_available == 'Yes' else '⚠️ Limited',
+            ))
             
         except Exception as e:
             error_msg = str(e)
-            if "nodename nor servname provided" in error_msg:
-                diagnosis = "❌ DNS Resolution Error - Check SAP server hostname"
-            elif "timed out" in error_msg:
-                diagnosis = "❌ Connection Timeout - Check SAP server accessibility"
-            elif "401" in error_msg:
-                diagnosis = "❌ Authentication Error - Check credentials"
-            elif "404" in error_msg:
-                diagnosis = "❌ Service Not Found - Check OData service URL"
-            else:
-                diagnosis = f"❌ Connection Error: {error_msg}"
+            diagnosis = next((message for needle, message in _CONNECTION_DIAGNOSES if needle in error_msg),
+                             f"❌ Connection Error: {error_msg}")
             
-            return f"""❌ SAP Connection Status: FAILED
-
-🔧 Configuration:
-- URL: {base_url}
-- Username: {username}
-- Password: {has_password}
-
-🔍 Diagnosis: {diagnosis}
-
-Please check your .env file configuration and network connectivity."""
+            return _CONNECTION_FAILED_TEMPLATE.format_map(dict(self._env, diagnosis=diagnosis))
     
     def sap_raw_request_tool(self, args):
         """Make raw HTTP request for maximum flexibility"""
@@ -826,16 +1441,16 @@ Please check your .env file configuration and network connectivity."""
         parameters = args.get("parameters", {})
         data = args.get("data")
         
-        data_json = json.dumps(data) if data else None
+        data_json = _json_bytes(data) if data else None
         result = self.sap_client._make_request(endpoint, parameters, method, data_json)
         
-        return f"🔧 Raw {method} request to {endpoint}:\n{json.dumps(result, indent=2)}"
+        return f"🔧 Raw {method} request to {endpoint}:\n{_json_dumps(result, pretty=True)}"
     
     def sap_discover_services_tool(self, args):
         """Discover all available SAP OData services"""
         pattern = args.get("pattern")
         
-        services = self.sap_client.discover_all_services()
+        services = self._available_services()
         
         if pattern:
             # Filter services by pattern
@@ -845,7 +1460,7 @@ Please check your .env file configuration and network connectivity."""
         if not services:
             return "❌ No SAP OData services found. Check system connectivity and permissions."
         
-        service_list = "\n".join([f"- {s['name']}: {s['description']}" for s in services])
+        service_list = "\n".join(f"- {s['name']}: {s['description']}" for s in services)
         
         return f"""🔍 Discovered SAP OData Services ({len(services)}):
 
@@ -867,27 +1482,22 @@ Please check your .env file configuration and network connectivity."""
         """Intelligently query entities across all services"""
         entity_set = args["entity_set"]
         
-        # Find the optimal service for this entity
+        # Find the optimal service for this entity (current service first, then the entity index)
+        services = self.sap_client._available_services
         optimal_service = self.sap_client.find_service_for_entity(entity_set)
         
-        if not optimal_service:
-            # Try to discover services first
-            self.sap_client.discover_all_services()
-            optimal_service = self.sap_client.find_service_for_entity(entity_set)
+        if not optimal_service and self.sap_client._available_services is services:
+            # The lookup ran on a service list loaded before this call, possibly stale; refresh it
+            # (a cache hit within CACHE_TTL) and search again only if it was actually reloaded
+            self._available_services()
+            if self.sap_client._available_services is not services:
+                optimal_service = self.sap_client.find_service_for_entity(entity_set)
         
         if optimal_service:
-            # Switch to optimal service
-            current_service = self.sap_client.current_service
-            self.sap_client.switch_service(optimal_service)
-            
-            try:
-                # Execute the query using regular sap_query logic
-                result = self.sap_query_tool(args)
-                return f"🎯 Auto-discovered entity '{entity_set}' in service '{optimal_service}':\n\n{result}"
-            finally:
-                # Restore original service
-                if current_service:
-                    self.sap_client.switch_service(current_service)
+            # Execute the query using regular sap_query logic, addressed to the optimal service;
+            # the client's current service is left untouched, so there is nothing to switch back
+            result = self.sap_query_tool(args, service=optimal_service)
+            return f"🎯 Auto-discovered entity '{entity_set}' in service '{optimal_service}':\n\n{result}"
         else:
             available_services = len(self.sap_client._available_services)
             return f"❌ Entity '{entity_set}' not found in any of the {available_services} available services. Use sap_discover_services to see all services."
@@ -902,28 +1512,20 @@ Please check your .env file configuration and network connectivity."""
         
         if service_count == 0:
             # Try to discover services
-            self.sap_client.discover_all_services()
+            self._available_services()
             info = self.sap_client.get_service_info()
             service_count = info["available_services"]
         
-        services_list = "\n".join([f"- {s['name']}: {s['description']}" for s in info["services"][:10]])  # Show first 10
+        services_list = "\n".join(f"- {s['name']}: {s['description']}" for s in info["services"][:10])  # Show first 10
         more_services = f"\n... and {service_count - 10} more" if service_count > 10 else ""
         
-        return f"""📊 SAP Service Information:
-
-🔧 Configuration:
-- Base URL: {base_url}
-- Current Service: {current_service}
-- Available Services: {service_count}
-
-📋 Available Services:
-{services_list}{more_services}
-
-🛠️ Available Operations:
-- sap_switch_service: Change active service
-- sap_smart_query: Auto-find service for entity
-- sap_discover_services: Find all services
-- sap_query: Query current service"""
+        return _SERVICE_INFO_TEMPLATE.format_map({
+            "base_url": base_url,
+            "current_service": current_service,
+            "service_count": service_count,
+            "services_list": services_list,
+            "more_services": more_services,
+        })
     
     def _format_query_result(self, data: Dict[str, Any], entity_set: str, params: Dict[str, str]) -> str:
         """Format query results with comprehensive information"""
@@ -935,7 +1537,7 @@ Please check your .env file configuration and network connectivity."""
             results = data["value"]
             count_info = f" (Total: {data.get('@odata.count', 'unknown')})" if "@odata.count" in data else ""
         else:
-            return f"📊 {entity_set} Response:\n{json.dumps(data, indent=2)}"
+            return f"📊 {entity_set} Response:\n{_json_dumps(data, pretty=True)}"
         
         result_count = len(results)
         
@@ -956,20 +1558,21 @@ Please check your .env file configuration and network connectivity."""
         
         query_info = f"Query: {', '.join(query_summary)}" if query_summary else "Query: All records"
         
+        omitted = ""
+        if result_count > self.MAX_DISPLAY_ROWS:
+            results = results[:self.MAX_DISPLAY_ROWS]
+            omitted = f"\n... and {result_count - self.MAX_DISPLAY_ROWS} more rows omitted (use $skip/$top to page through them)"
+        
         return f"""📊 SAP Query Results for {entity_set}:
 
 🔍 {query_info}
 📈 Records: {result_count}{count_info}
 
 📋 Data:
-{json.dumps(results, indent=2)}"""
+{_json_dumps(results, pretty=True)}{omitted}"""
     
     def error_response(self, msg_id, error_msg):
-        return json.dumps({
-            "jsonrpc": "2.0",
-            "id": msg_id,
-            "error": {"code": -1, "message": error_msg}
-        })
+        return _ERROR_ENVELOPE % (_json_bytes(msg_id), _json_bytes(error_msg))
 
 
 def main():
@@ -981,15 +1584,48 @@ def main():
     print("     sap_raw_request, sap_discover_services, sap_switch_service, sap_smart_query, sap_service_info", file=sys.stderr)
     print("🎯 Intelligent, multi-service SAP integration ready!", file=sys.stderr)
     
+    # JSON-RPC traffic stays UTF-8 bytes end to end, no text-layer transcoding
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    write_lock = threading.Lock()
+    waiting_lock = threading.Lock()
+    waiting = 0  # responses that are ready and queued behind write_lock
+    
+    def respond(line: bytes):
+        nonlocal waiting
+        try:
+            response = server.handle_message(line) + b"\n"
+            with waiting_lock:
+                waiting += 1
+            with write_lock:
+                try:
+                    stdout.write(response)
+                finally:
+                    with waiting_lock:
+                        waiting -= 1
+                        idle = waiting == 0
+                # Flush once no other response is about to be written, not after every one
+                if idle:
+                    stdout.flush()
+        except Exception as e:
+            # Nothing collects the worker's future, so report here instead of losing the error
+            print(f"✗ Failed to answer message: {str(e)}", file=sys.stderr)
+    
+    # Tool calls mostly wait on SAP, so messages are handled concurrently and each
+    # response is written as soon as it is ready; the JSON-RPC id pairs it with its request
+    executor = ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_REQUESTS)
     try:
-        for line in sys.stdin:
+        while True:
+            line = stdin.readline()
+            if not line:
+                break
             line = line.strip()
             if line:
-                response = server.handle_message(line)
-                print(response)
-                sys.stdout.flush()
+                executor.submit(respond, line)
     except KeyboardInterrupt:
         print("Server stopped.", file=sys.stderr)
+    finally:
+        # Let in-flight requests finish answering before the process exits
+        executor.shutdown(wait=True)
 
 
 if __name__ == "__main__":